@@ -5,24 +5,31 @@ import asyncio
 import atexit
 import functools
 import gzip
+import inspect
 import io
+import itertools
 import json
 import logging
+import os
 import pathlib
+import pickle
 import shutil
 import time
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta, timezone
 from functools import lru_cache, partial
 
 import aiohttp
 import lxml.etree as ET
+import orjson
+import PIL
 import xmltv.models
-from diskcache import Cache
+import zstandard
+from diskcache import FanoutCache
 from furl import furl
 from PIL import Image
 from pydantic import ValidationError
 from tqdm import tqdm
-from tqdm.asyncio import tqdm as async_tqdm
 from xsdata.formats.dataclass.serializers import XmlSerializer
 from xsdata.formats.dataclass.serializers.config import SerializerConfig
 
@@ -47,7 +54,15 @@ def load_dict(filename):
 
 
 VERSION = '0.1.0'
-DISK_CACHE = Cache(root_dir() / 'cache', size_limit=2**32)  # 2**32 bytes == 4 GB
+DISK_CACHE = FanoutCache(root_dir() / 'cache', shards=8, size_limit=2**32)  # 4 GB total
+RESIZE_POOL = ProcessPoolExecutor(max_workers=os.cpu_count())  # CPU-bound image resize
+
+# Cache values pickled above the threshold get zstd-compressed,
+# magic byte tells them apart from legacy uncompressed entries.
+CACHE_COMPRESS_MAGIC = b'\x01'
+CACHE_COMPRESS_THRESHOLD = 4096
+CACHE_COMPRESSOR = zstandard.ZstdCompressor(level=3)
+CACHE_DECOMPRESSOR = zstandard.ZstdDecompressor()
 DISK_CACHE_EXPIRE = int(timedelta(days=3).total_seconds())  # 3 days cache expire
 
 XMLTV_PROGRAM_OPTIONS = {
@@ -61,6 +76,13 @@ XMLTV_PROGRAM_OPTIONS = {
 USER_AGENT = ('Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 '
               '(KHTML, like Gecko) Chrome/102.0.5005.63 Safari/537.36')
 HEADERS = {'Referer': 'http://123tv.live/', 'User-Agent': USER_AGENT}
+TVGUIDE_HEADERS = {'Referer': 'https://google.com', 'User-Agent': USER_AGENT}
+TVGUIDE_TAGS_HEADERS = {**HEADERS, 'Referer': 'https://www.tvguide.com/'}
+
+# Shared HTTP sessions keyed by headers,
+# connector limit is overridden by `--parallel` option.
+_SESSIONS = {}
+_SESSION_CONNECTOR_LIMIT = 20
 
 logging.basicConfig(
     level=logging.INFO, format='%(asctime)s :: %(levelname)s :: %(message)s',
@@ -69,18 +91,42 @@ logging.basicConfig(
 
 logger = logging.getLogger(__name__)
 
+# Pillow-SIMD versions carry a ".postN" suffix, stock Pillow
+# satisfies `from PIL import Image` silently without SIMD speedup.
+if '.post' not in getattr(PIL, '__version__', ''):
+    logger.warning('Pillow-SIMD is not installed, '
+                   'image resize falls back to stock Pillow')
+
 
 async def gather_with_concurrency(n, *tasks, show_progress=True, progress_title=None):
-    """Gather tasks with concurrency."""
-    semaphore = asyncio.Semaphore(n)
+    """Gather tasks with at most `n` worker tasks pulling from a queue."""
+    queue = asyncio.Queue()
+    for index, task in enumerate(tasks):
+        queue.put_nowait((index, task))
+
+    results = [None] * len(tasks)
+    progress = tqdm(total=len(tasks), desc=progress_title) if show_progress else None
+
+    async def worker():
+        while not queue.empty():
+            index, task = queue.get_nowait()
+            results[index] = await task
+            if progress:
+                progress.update()
+
+    workers = [asyncio.create_task(worker()) for _ in range(min(n, len(tasks)))]
+    try:
+        await asyncio.gather(*workers)
+    finally:
+        # Don't leave unawaited coroutines behind on worker failure
+        while not queue.empty():
+            _, task = queue.get_nowait()
+            task.close()
 
-    async def sem_task(task):
-        async with semaphore:
-            return await task
+        if progress:
+            progress.close()
 
-    gather = partial(async_tqdm.gather, desc=progress_title) if show_progress \
-        else asyncio.gather
-    return await gather(*[sem_task(x) for x in tasks])
+    return results
 
 
 @atexit.register
@@ -90,15 +136,46 @@ def close_cache():
     DISK_CACHE.close()
 
 
+def get_session(headers=None):
+    """Get shared HTTP session with keep-alive connection pool."""
+    key = frozenset(headers.items()) if headers else None
+    session = _SESSIONS.get(key)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(limit=_SESSION_CONNECTOR_LIMIT,
+                                         ttl_dns_cache=300, keepalive_timeout=60)
+        session = aiohttp.ClientSession(headers=headers, connector=connector,
+                                        raise_for_status=True)
+        _SESSIONS[key] = session
+
+    return session
+
+
+async def close_sessions():
+    """Close all shared HTTP sessions."""
+    for session in _SESSIONS.values():
+        if not session.closed:
+            await session.close()
+
+    _SESSIONS.clear()
+
+
 def download_cached_by_url(func):
     """Cached wrapper for `download_with_retries`."""
     @functools.wraps(func)
     async def inner(url, *args, **kwargs):
         result = DISK_CACHE.get(key=url)
+        if isinstance(result, bytes) and result[:1] == CACHE_COMPRESS_MAGIC:
+            result = pickle.loads(CACHE_DECOMPRESSOR.decompress(result[1:]))
+
         if not result:
             result = await func(url, *args, **kwargs)
             if result:
-                DISK_CACHE.set(key=url, value=result, expire=DISK_CACHE_EXPIRE)
+                value = pickle.dumps(result, protocol=pickle.HIGHEST_PROTOCOL)
+                if len(value) > CACHE_COMPRESS_THRESHOLD:
+                    value = CACHE_COMPRESS_MAGIC + CACHE_COMPRESSOR.compress(value)
+                else:
+                    value = result
+                DISK_CACHE.set(key=url, value=value, expire=DISK_CACHE_EXPIRE)
 
         return result
 
@@ -121,9 +198,17 @@ async def download_with_retries(url, headers=None, timeout=1, timeout_increment=
     retry = 1
     while True:
         try:
-            async with aiohttp.ClientSession(headers=headers, raise_for_status=True) as session:
-                async with session.get(url, timeout=timeout) as response:
-                    return loader(await getattr(response, method)())
+            async with get_session(headers).get(url, timeout=timeout) as response:
+                if method == 'json':
+                    # orjson decodes big schedule payloads much
+                    # faster than aiohttp's stdlib json
+                    data = orjson.loads(await response.read())
+                else:
+                    data = await getattr(response, method)()
+                result = loader(data)
+                if inspect.isawaitable(result):
+                    result = await result
+                return result
         except Exception as e:
             is_exc_valid = any([isinstance(e, exc) for exc in exceptions])
             if not is_exc_valid:
@@ -145,7 +230,7 @@ async def download_programs(channel):
         % (channel['tvguide_id'], time.time())  # NOTE: 100% cache miss
 
     def loader(response):
-        programs = sum(response.get('items', {}).values(), [])
+        programs = itertools.chain.from_iterable(response.get('items', {}).values())
         return [models.ustvgo.Program(**program) for program in programs]
 
     channel['programs'] = await download_with_retries(
@@ -156,7 +241,6 @@ async def download_programs(channel):
 
 async def download_program_detail(program):
     """Download program details from tvguide.com"""
-    headers = {'Referer': 'https://google.com', 'User-Agent': USER_AGENT}
     url = ('https://cmg-prod.apigee.net/v1/xapi/tvschedules/'
            'tvguide/programdetails/%d/web' % program.id)
 
@@ -164,7 +248,7 @@ async def download_program_detail(program):
         return models.tvguide.ProgramDetails(**response['data']['item'])
 
     program._details = await download_with_retries(
-        url, headers, loader=loader,
+        url, TVGUIDE_HEADERS, loader=loader,
         extra_exceptions=[ValidationError, KeyError]
     )
 
@@ -172,7 +256,6 @@ async def download_program_detail(program):
 async def download_program_cast(program):
     """Download program Cast & Crew."""
     if program._details and program._details.mcoId:
-        headers = {'Referer': 'https://google.com', 'User-Agent': USER_AGENT}
         url = ('https://cmg-prod.apigee.net/v1/xapi/composer/tvguide/pages/'
                'shows-cast/%d/web?contentOnly=true' % program._details.mcoId)
 
@@ -189,50 +272,87 @@ async def download_program_cast(program):
             return models.tvguide.ShowsCast(id='0', items=[])
 
         program._cast = await download_with_retries(
-            url, headers, loader=loader,
+            url, TVGUIDE_HEADERS, loader=loader,
             extra_exceptions=[ValidationError, KeyError, AttributeError]
         )
 
 
+def _resize_image(response, images_size, images_quality):
+    """Resize downloaded image, runs in `RESIZE_POOL` workers.
+
+    Returns resized image bytes along with their dimensions.
+    """
+    with Image.open(io.BytesIO(response)) as img:
+        img_format = img.format
+        # Let libjpeg decode JPEGs already downscaled (no-op for other
+        # formats), 2x target size keeps quality for the final resample.
+        img.draft(img.mode, (images_size * 2, images_size * 2))
+
+        # Integer box-downsample big sources first, feeding fewer
+        # pixels into the expensive Lanczos kernel. `reduce` doesn't
+        # support palette and bilevel modes, skip those.
+        factor = min(img.size) // (2 * images_size)
+        if factor > 1 and img.mode not in ('P', '1'):
+            img = img.reduce(factor)
+
+        img.thumbnail((images_size, images_size), Image.LANCZOS)
+        bytesio = io.BytesIO()
+        img.save(bytesio, format=img_format, quality=images_quality)
+        return bytesio.getbuffer().tobytes(), img.width, img.height
+
+
 async def download_program_images(program, images_size, images_quality, base_url):
     """Download and resize program images."""
     if not program._details:
         return  # Nothing to download, bail
 
     def loader(response):
-        """Image resize in loader for
-        reducing disk cache size."""
-        with Image.open(io.BytesIO(response)) as img:
-            img.thumbnail((images_size, images_size))
-            bytesio = io.BytesIO()
-            img.save(bytesio, format=img.format, quality=images_quality)
-            return bytesio.getbuffer().tobytes()
+        """Offload CPU-bound resize to worker processes, resize in
+        loader also keeps the disk cache size down."""
+        return asyncio.get_running_loop().run_in_executor(
+            RESIZE_POOL, _resize_image, response, images_size, images_quality)
 
     for image in program._details.images:
         try:
             # Download image
-            img_bytes = await download_with_retries(
+            result = await download_with_retries(
                 image.url, method='read', loader=loader,
                 timeout=15, timeout_max=120, timeout_increment=10
             )
 
+            if isinstance(result, tuple):
+                img_bytes, img_width, img_height = result
+            else:
+                # Cache entry from before the loader returned dimensions
+                img_bytes = result
+                with Image.open(io.BytesIO(img_bytes)) as img:
+                    img_width, img_height = img.size
+
             # Path for img
             img_path = root_dir() / 'images' / 'posters' / image.bucketPath.lstrip('/')
             img_path.parent.mkdir(parents=True, exist_ok=True)
 
             # Save preloaded image
-            iobytes = io.BytesIO(img_bytes)
-            img_path.write_bytes(iobytes.getbuffer())
+            img_path.write_bytes(img_bytes)
 
             # Update image parameters
-            with Image.open(iobytes) as img:
-                image.width = img.width
-                image.height = img.height
-                image.bucketPath = (furl(base_url) / 'images/posters' / image.bucketPath).url
-                image.bucketType = 'local'
+            image.width = img_width
+            image.height = img_height
+            image.bucketPath = (base_url.rstrip('/') + '/images/posters/'
+                                + image.bucketPath.lstrip('/'))
+            image.bucketType = 'local'
         except Exception as e:
-            logger.warn(('Something bad happened during '
-                         'working with image: %s (URL: %s)', e, image.url))
+            logger.warning('Something bad happened during '
+                           'working with image: %s (URL: %s)', e, image.url)
+
+
+async def process_program(program, images_size, images_quality, base_url):
+    """Download program details, then its credits and images concurrently."""
+    await download_program_detail(program)
+    await asyncio.gather(
+        download_program_cast(program),
+        download_program_images(program, images_size, images_quality, base_url),
+    )
 
 
 async def download_program_tags(channels):
@@ -243,29 +363,38 @@ async def download_program_tags(channels):
     provider_id = '9100001138'  # Eastern Time Zone
     url = ('https://cmg-prod.apigee.net/v1/xapi/tvschedules'
            f'/tvguide/{provider_id}/web?start={start_ts}&duration={duration_mins}')
-    headers = {**HEADERS, 'Referer': 'https://www.tvguide.com/'}
 
     def loader(response):
-        programs = sum([x['programSchedules'] for x in response['data']['items']], [])
+        programs = itertools.chain.from_iterable(
+            x['programSchedules'] for x in response['data']['items'])
         programs_and_attrs = {(x['programId'], x['startTime']): x['airingAttrib'] for x in programs
                               if x['airingAttrib'] and x['programId']}
         return programs_and_attrs
 
-    data = await download_with_retries(url, headers, loader=loader,
+    data = await download_with_retries(url, TVGUIDE_TAGS_HEADERS, loader=loader,
                                        timeout=30, timeout_increment=5, timeout_max=60)
     if data:
-        programs_new = {k for k, v in data.items() if v & 0b100}
-        programs_live = {k for k, v in data.items() if v & 0b1}
-
         for channel in channels:
-            for program in channel['programs']:
-                if (program.id, program.start_timestamp) in programs_new:
+            for program, key in zip(channel['programs'], channel['_program_keys']):
+                attrib = data.get(key, 0)
+                if attrib & 0b100:
                     program.tags.append('new')
 
-                if (program.id, program.start_timestamp) in programs_live:
+                if attrib & 0b1:
                     program.tags.append('live')
 
 
+XMLTV_DATE_FORMAT = '%Y%m%d%H%M%S %z'
+
+
+@lru_cache(maxsize=None)
+def xmltv_date(timestamp):
+    """Format UNIX timestamp to XMLTV date, cached since
+    programs share schedule grid boundaries across channels."""
+    date = datetime.fromtimestamp(timestamp, tz=timezone.utc)
+    return date.strftime(XMLTV_DATE_FORMAT)
+
+
 @lru_cache
 def icon_manifest(manifest_name):
     """Load icon manifest."""
@@ -274,12 +403,13 @@ def icon_manifest(manifest_name):
     return manifest
 
 
+@lru_cache(maxsize=256)
 def xmltv_icon(icon_name, manifest_name, base_url):
     """Get XMLTV icon."""
     manifest = icon_manifest(manifest_name)
     if icon_name in manifest:
         icon_info = manifest[icon_name]
-        icon_src = (furl(base_url) / 'images/icons' / icon_info['path']).url
+        icon_src = base_url.rstrip('/') + '/images/icons/' + icon_info['path'].lstrip('/')
         return xmltv.models.Icon(src=icon_src, width=icon_info['width'], height=icon_info['height'])
 
     return None
@@ -295,9 +425,15 @@ def make_xmltv(channels, filepath, base_url, icons_for_light_bg):
 
     get_icon = partial(xmltv_icon, base_url=base_url)
 
+    # Pre-bind hot-loop lookups to locals
+    programme_append = tv.programme.append
+    make_programme = models.xmltv.Programme
+    make_title = xmltv.models.Title
+
     for channel in tqdm(channels, desc='Make EPG XMLTV'):
         # Add channels
         channel_id = channel['stream_id']
+        channel_lang = channel['language']
         xmltv_channel = xmltv.models.Channel(
             display_name=channel['name'],
             id=channel_id
@@ -322,18 +458,18 @@ def make_xmltv(channels, filepath, base_url, icons_for_light_bg):
             if program._details:
                 # Convert program details to xmltv program
                 xmltv_program = program._details.to_xmltv(
-                    get_icon=get_icon, lang=channel['language'],
+                    get_icon=get_icon, lang=channel_lang,
                     **XMLTV_PROGRAM_OPTIONS
                 )
             else:
                 # Create program without details
-                xmltv_program = models.xmltv.Programme(
-                    title=[xmltv.models.Title(content=[program.name], lang=channel['language'])],
+                xmltv_program = make_programme(
+                    title=[make_title(content=[program.name], lang=channel_lang)],
                     clumpidx=None,
                 )
 
             # Bind current channel to the program
-            xmltv_program.channel = channel['stream_id']
+            xmltv_program.channel = channel_id
 
             # Add tags
             if 'new' in program.tags:
@@ -343,37 +479,54 @@ def make_xmltv(channels, filepath, base_url, icons_for_light_bg):
                 xmltv_program.live = ''
 
             # Start / End dates
-            start_ts = datetime.fromtimestamp(program.start_timestamp, tz=timezone.utc)
-            end_ts = datetime.fromtimestamp(program.end_timestamp, tz=timezone.utc)
-
-            xmltv_program.start = start_ts.strftime('%Y%m%d%H%M%S %z')
-            xmltv_program.stop = end_ts.strftime('%Y%m%d%H%M%S %z')
+            xmltv_program.start = xmltv_date(program.start_timestamp)
+            xmltv_program.stop = xmltv_date(program.end_timestamp)
 
             # Add Cast & Crew
             if program._cast:
                 program._cast.add_cast(xmltv_program)
 
-            tv.programme.append(xmltv_program)
+            programme_append(xmltv_program)
 
     # Write EPG XMLTV to target file path
     write_file_from_xml(filepath, tv, base_url)
 
 
 def postprocess_xml(xml_filepath):
-    """Postprocess output XML file."""
-    xml = ET.parse(xml_filepath)
+    """Postprocess output XML file in a single streaming pass."""
     xsi_type = '{http://www.w3.org/2001/XMLSchema-instance}type'
+    tmp_filepath = xml_filepath.with_name(xml_filepath.name + '.tmp')
+
+    context = ET.iterparse(str(xml_filepath), events=('start', 'end'),
+                           remove_blank_text=True)
+    _, root = next(context)  # Grab root on its "start" event
+
+    with ET.xmlfile(str(tmp_filepath), encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element(root.tag, root.attrib, nsmap=root.nsmap):
+            xf.write('\n')
+            for event, element in context:
+                if event != 'end' or element.getparent() is not root:
+                    continue
 
-    for programme in xml.findall('programme'):
-        programme.attrib.pop(xsi_type, None)
+                if element.tag == 'programme':
+                    element.attrib.pop(xsi_type, None)
 
-    xml.write(xml_filepath, pretty_print=True, encoding='utf-8', xml_declaration=True)
+                # Detach before writing, so the root namespace declarations
+                # don't get repeated on every element, it also frees
+                # subtrees already written out
+                root.remove(element)
+                xf.write(element, pretty_print=True)
+
+    os.replace(tmp_filepath, xml_filepath)
 
 
 def write_file_from_xml(xml_filepath, serialize_class, base_url):
     """Method to write serialized XML data to a file."""
+    # Serialize compact, the single streaming
+    # postprocess pass handles pretty-printing
     serializer = XmlSerializer(config=SerializerConfig(
-        pretty_print=True,
+        pretty_print=False,
         encoding='UTF-8',
         xml_version='1.0',
         xml_declaration=True,
@@ -389,39 +542,44 @@ def write_file_from_xml(xml_filepath, serialize_class, base_url):
 async def download_and_make_epg(filepath, parallel, create_archive, images_size,
                                 images_quality, base_url, icons_for_light_bg):
     """Download channels' programs and make XMLTV EPG."""
+    global _SESSION_CONNECTOR_LIMIT
+    _SESSION_CONNECTOR_LIMIT = parallel * 2
+
     channels = load_dict('channels.json')
     download_tasks = [download_programs(channel) for channel in channels]
 
-    # Download programs per each channel from USTVGO
-    await gather_with_concurrency(parallel, *download_tasks, progress_title='Download programs')
-
-    # Download program details from TVGUIDE
-    for channel in tqdm(channels, desc='Download details'):
-        download_tasks = [download_program_detail(program) for program in channel['programs']]
-        await gather_with_concurrency(parallel, *download_tasks, show_progress=False)
-
-    # Download program cast (actors, directors, writers, etc) from TVGUIDE
-    for channel in tqdm(channels, desc='Download credits'):
-        download_tasks = [download_program_cast(program) for program in channel['programs']]
-        await gather_with_concurrency(parallel, *download_tasks, show_progress=False)
-
-    # Download and resize images from TVGUIDE
-    shutil.rmtree(root_dir() / 'images' / 'posters', ignore_errors=True)  # Remove old imgs first
-    for channel in tqdm(channels, desc='Download images'):
-        download_tasks = [download_program_images(program, images_size, images_quality, base_url)
-                          for program in channel['programs']]
-        await gather_with_concurrency(parallel, *download_tasks, show_progress=False)
+    try:
+        # Download programs per each channel from USTVGO
+        await gather_with_concurrency(parallel, *download_tasks,
+                                      progress_title='Download programs')
+
+        # Download program details, cast (actors, directors, writers, etc)
+        # and images from TVGUIDE, chained per program in one pipelined
+        # pass so a slow channel doesn't stall the others
+        shutil.rmtree(root_dir() / 'images' / 'posters', ignore_errors=True)  # Remove old imgs
+        download_tasks = [process_program(program, images_size, images_quality, base_url)
+                          for channel in channels for program in channel['programs']]
+        await gather_with_concurrency(parallel, *download_tasks,
+                                      progress_title='Download program data')
+
+        # Materialize per-channel composite keys once,
+        # the tag pass below probes one per program
+        for channel in channels:
+            channel['_program_keys'] = [(program.id, program.start_timestamp)
+                                        for program in channel['programs']]
 
-    # Add tags for programs,
-    # could be usefull for IPTV recorders.
-    await download_program_tags(channels)
+        # Add tags for programs,
+        # could be usefull for IPTV recorders.
+        await download_program_tags(channels)
+    finally:
+        await close_sessions()
 
     # Make EPG
     make_xmltv(channels, filepath, base_url, icons_for_light_bg)
 
     if create_archive:
-        with gzip.open(f'{filepath}.gz', 'wb') as f:
-            f.write(filepath.read_bytes())
+        with open(filepath, 'rb') as src, gzip.open(f'{filepath}.gz', 'wb') as dst:
+            shutil.copyfileobj(src, dst, length=2**20)  # 1 MB chunks
 
 
 def main():